@@ -1,137 +1,460 @@
 #!/usr/bin/python3
+import argparse
+import os
+import select
 import socket
 import cv2
 import numpy as np
 import threading
 import time
-from queue import Queue, Empty
-
-# --- 設定 ---
+import multiprocessing
+from multiprocessing import shared_memory
+from queue import Full, Empty
+
+# CUDA搭載機ではnvJPEGでデコードをGPUへオフロードする
+# (Huffman展開・IDCT・色変換をGPU側で行い、CPU負荷をほぼゼロにする)
+# ハンドル生成はdecode_worker内で行う (fork前に作ったCUDAコンテキストは
+# 子プロセスで使えないため、ここではimportのみ)
+try:
+    from nvjpeg import NvJpeg
+except Exception:
+    NvJpeg = None
+
+# Numbaがあればパケット処理のホットパスを機械語化する
+try:
+    from numba import njit
+except Exception:
+    njit = None
+
+# TurboJPEGが使えればSIMD対応のlibjpeg-turboで直接BGRデコードする
+# (cv2.imdecodeのRGB⇔BGR変換を省けるためデコードが速い)
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except Exception:
+    TurboJPEG = None
+
+# --- 設定 (コマンドライン引数で上書き可能) ---
 BIND_IP = "0.0.0.0"
 PORT = 50000          # 受信するポート番号（1つのみ）
 BUFFER_SIZE = 65535
+RCVBUF_SIZE = 12 * 1024 * 1024  # 10Gb/s・バースト耐性向けの推奨値
+SO_RCVBUFFORCE = 33             # Linux固有 (socketモジュール未定義の環境向け)
+
+# 送信側(udp_sender.cpp)のパケットフォーマットと一致させること
+HEADER_SIZE = 5                 # frame_id:u16 + seq:u16 + flag:u8
+MAX_PAYLOAD = 1400              # 送信側MAX_CHUNK_SIZE
 
 DISPLAY_FPS = 30
 DISPLAY_INTERVAL = 1.0 / DISPLAY_FPS
 WINDOW_NAME = "Video Stream"
 
+# デバッグ表示に必要な解像度 (これを下回らない範囲でデコード時に縮小する)
+DISPLAY_MIN_W = 960
+DISPLAY_MIN_H = 540
+
+# pollKeyはOpenCV 4.5以降のみ
+_has_pollkey = hasattr(cv2, "pollKey")
+
 running = True
 
-# UDP → JPEGバイト列（常に最新1枚）
-raw_queue = Queue(maxsize=1)
+# デコード済みフレームの最大サイズ (共有メモリの確保量)
+MAX_FRAME_W = 1920
+MAX_FRAME_H = 1080
+FRAME_SHM_NAME = "debug_rx_frame"   # 共有メモリ名のプレフィックス
+
+# 共有メモリは2面持ち: 表示中のスロットをデコーダが上書きしないようにする
+SHM_SLOTS = 2
+
+# UDP → JPEGバイト列（デコードは子プロセスで行いGIL競合を避ける）
+jpeg_queue = multiprocessing.Queue(maxsize=2)
+
+# リスナー即時終了用のwakeupパイプ (終了時にwrite側へ1バイト書く)
+wakeup_r, wakeup_w = os.pipe()
+
+# 役割ごとのCPUコア割り当て (コア数が足りない環境では折り返す)
+LISTENER_CORE = 0
+DECODE_CORE = 1
+DISPLAY_CORE = 2
+
+
+def copy_payload(frame_arr, off, pkt_arr, start, end):
+    """payloadを再構成バッファの指定位置へコピーする
+
+    パケット毎に呼ばれるホットパスなので、Numbaがあれば
+    インタプリタを通らない機械語版に差し替えられる。
+    """
+    frame_arr[off:off + (end - start)] = pkt_arr[start:end]
+
+
+if njit is not None:
+    copy_payload = njit(cache=True)(copy_payload)
+
+
+def set_affinity(core_id):
+    """呼び出し元のスレッド/プロセスを指定コアへ固定する
 
-# JPEG → デコード済み画像（常に最新1枚）
-frame_queue = Queue(maxsize=1)
+    リスナーとデコーダを別コアに固定すると、フレームバッファの
+    キャッシュラインがコア間を往復せずに済む。非対応環境では何もしない。
+    """
+    try:
+        os.sched_setaffinity(0, {core_id % os.cpu_count()})
+    except (AttributeError, OSError):
+        pass
 
-# 分割パケット再構成用バッファ
-frame_buffer = bytearray()
+# 分割パケット再構成用バッファの上限サイズ (1080p JPEG 1枚に十分な1MiB)
+MAX_JPEG_BYTES = 1 << 20
 
 
 def udp_listener():
     """UDPパケットを受信し、JPEGデータを再構成するスレッド"""
     global running
-    
+
+    set_affinity(LISTENER_CORE)
+    # 権限があればリアルタイムスケジューリングにし、バースト受信中の
+    # 横取りを防ぐ (CAP_SYS_NICEが無ければ黙って通常優先度のまま)
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+    except (AttributeError, OSError):
+        pass
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # SO_REUSEPORT: 同一ポートへ複数ソケットをbind可能にする
+    # (カーネルがフロー単位で振り分けるため、将来リスナーを増やして
+    #  受信処理を並列化できる。再起動直後のbind失敗も防げる)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # 受信バッファを大きめに設定
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
-    sock.settimeout(1.0)
+    # SO_RCVBUFFORCEならnet.core.rmem_maxの上限を超えられる (CAP_NET_ADMIN必須)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RCVBUF_SIZE)
+    except (OSError, PermissionError):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+    # 実際に確保された値を表示 (rmem_maxで黙って切り詰められるため)
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    print(f"[UDP] SO_RCVBUF = {actual} bytes")
+    # selectで待ち、到着済みのdatagramはまとめて処理する
+    sock.setblocking(False)
+
+    # 再構成用バッファは固定長を1度だけ確保し、memoryview経由で書き込む
+    # (bytearray.extendの再確保・コピーを毎パケット行わないため)
+    frame_buf = bytearray(MAX_JPEG_BYTES)
+    frame_view = memoryview(frame_buf)
+    # copy_payload (Numba対応) へ渡すためのnumpyビュー (どちらもゼロコピー)
+    frame_arr = np.frombuffer(frame_buf, dtype=np.uint8)
+
+    # 再構成中フレームの状態 (seq番号で書き込み位置を決めるため、
+    # UDPの順序入替があっても正しく組み立てられる)
+    cur_frame_id = -1
+    seen_seqs = set()
+    eof_total = -1
+    frame_len = 0
+
+    # パケット受信用バッファも固定長を使い回す
+    # (recvfromは毎パケット64KiBのbytesを新規確保するため)
+    pkt_buf = bytearray(BUFFER_SIZE)
+    pkt_view = memoryview(pkt_buf)
+    pkt_arr = np.frombuffer(pkt_buf, dtype=np.uint8)
 
     try:
         sock.bind((BIND_IP, PORT))
         print(f"[UDP] Listening on port {PORT}")
 
         while running:
-            try:
-                data, _ = sock.recvfrom(BUFFER_SIZE)
-                if len(data) < 2:
+            # パケット到着または終了通知までselectで待機
+            # (タイムアウトポーリングなし: 無通信時の起床はゼロ、終了は即時)
+            readable, _, _ = select.select([sock, wakeup_r], [], [])
+            if wakeup_r in readable:
+                break
+
+            # 1回の起床でキュー済みdatagramを全て捌く（syscall待ち回数を削減）
+            while True:
+                try:
+                    # 確保済みバッファへ直接受信 (per-packetのbytes確保を回避)
+                    pkt_len = sock.recv_into(pkt_view)
+                except BlockingIOError:
+                    break
+                except Exception as e:
+                    print(f"[UDP] Error: {e}")
+                    cur_frame_id = -1
+                    break
+
+                if pkt_len < HEADER_SIZE + 1:
                     continue
 
-                # 先頭1バイトをフラグとして使用
-                flag = data[0]
-                payload = data[1:]
+                # 5バイトヘッダ (frame_id:u16, seq:u16, flag:u8) を解析
+                frame_id = (pkt_buf[0] << 8) | pkt_buf[1]
+                seq = (pkt_buf[2] << 8) | pkt_buf[3]
+                flag = pkt_buf[4]
+                payload_len = pkt_len - HEADER_SIZE
+
+                # 別フレームのパケットが来たら作りかけのフレームは破棄
+                if frame_id != cur_frame_id:
+                    cur_frame_id = frame_id
+                    seen_seqs.clear()
+                    eof_total = -1
+                    frame_len = 0
+
+                # seqから書き込み位置を算出 (バッファ溢れはフレームごと破棄)
+                write_off = seq * MAX_PAYLOAD
+                if write_off + payload_len > MAX_JPEG_BYTES:
+                    cur_frame_id = -1
+                    continue
 
-                # バッファに追記
-                frame_buffer.extend(payload)
+                # 確保済みバッファへ直接書き込み
+                copy_payload(frame_arr, write_off, pkt_arr,
+                             HEADER_SIZE, pkt_len)
+                seen_seqs.add(seq)
 
-                # フラグが1ならフレーム終了（JPEG完成）
+                # フラグが1なら最終パケット (フレーム全長が確定する)
                 if flag == 1:
-                    jpeg_data = bytes(frame_buffer)
-                    frame_buffer.clear()
-
-                    # 最新フレームのみをキューに入れる（古いのは捨てる）
-                    if raw_queue.full():
-                        raw_queue.get_nowait()
-                    raw_queue.put_nowait(jpeg_data)
-
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print(f"[UDP] Error: {e}")
-                frame_buffer.clear()
+                    eof_total = seq + 1
+                    frame_len = write_off + payload_len
+
+                # 全パケットが揃ったらJPEG完成
+                if eof_total != -1 and len(seen_seqs) == eof_total:
+                    cur_frame_id = -1
+
+                    # SOI/EOIマーカーを確認し、壊れたJPEGは
+                    # デコーダに渡さず捨てる（無駄なフルスキャンを回避）
+                    if (frame_len < 4
+                            or frame_buf[0] != 0xFF
+                            or frame_buf[1] != 0xD8
+                            or frame_buf[frame_len - 2] != 0xFF
+                            or frame_buf[frame_len - 1] != 0xD9):
+                        continue
+
+                    # デコードスレッドへ渡す分のみコピーし、バッファは再利用
+                    jpeg_data = bytes(frame_view[:frame_len])
+
+                    # 最新フレームのみをキューへ（満杯なら古いのを捨てる）
+                    try:
+                        jpeg_queue.put_nowait(jpeg_data)
+                    except Full:
+                        try:
+                            jpeg_queue.get_nowait()
+                        except Empty:
+                            pass
+                        try:
+                            jpeg_queue.put_nowait(jpeg_data)
+                        except Full:
+                            pass
 
     finally:
         sock.close()
 
 
-def decode_worker():
-    """受信したJPEGデータをデコードするスレッド"""
-    global running
+def pick_scaling_factor(src_w, src_h):
+    """表示に足りる範囲で最も縮小率の高いIDCTスケールを選ぶ
 
-    while running:
+    libjpeg-turboは1/2, 1/4, 1/8のスケールドIDCTに対応しており、
+    高周波DCT係数の計算を丸ごと省けるためフルデコードより大幅に速い。
+    """
+    best = (1, 1)
+    for num, den in ((1, 2), (1, 4), (1, 8)):
+        if (src_w * num // den >= DISPLAY_MIN_W
+                and src_h * num // den >= DISPLAY_MIN_H):
+            best = (num, den)
+    return best
+
+
+def decode_worker(shm_name, frame_shape, frame_ready):
+    """受信したJPEGデータをデコードする子プロセス
+
+    デコード結果は共有メモリへ直接書き込み、frame_shapeに実サイズを、
+    frame_readyに完成通知を載せる（プロセス境界でのフレームコピーを回避）。
+    """
+    set_affinity(DECODE_CORE)
+
+    # デコーダのハンドルはfork後のこのプロセス内で生成する
+    nv_jpeg = None
+    if NvJpeg is not None:
         try:
-            # キューからJPEGデータを取得
-            jpeg_data = raw_queue.get(timeout=0.5)
-            
-            # デコード処理
-            np_data = np.frombuffer(jpeg_data, dtype=np.uint8)
-            frame = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
-
-            if frame is not None:
-                # デコード済み画像をキューへ
-                if frame_queue.full():
-                    frame_queue.get_nowait()
-                frame_queue.put_nowait(frame)
-            else:
-                print("[Decode] Failed to decode image")
+            nv_jpeg = NvJpeg()
+        except Exception:
+            nv_jpeg = None
+    turbo_jpeg = None
+    if TurboJPEG is not None:
+        try:
+            turbo_jpeg = TurboJPEG()
+        except Exception:
+            turbo_jpeg = None
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shm_frame = np.ndarray(
+        (SHM_SLOTS, MAX_FRAME_H, MAX_FRAME_W, 3),
+        dtype=np.uint8, buffer=shm.buf)
+
+    # 直前に公開したスロットの裏面へ書く (表示側とのダブルバッファ)
+    write_slot = 0
+
+    try:
+        while True:
+            # キューからJPEGデータを取得 (Noneは終了通知)
+            jpeg_data = jpeg_queue.get()
+            if jpeg_data is None:
+                break
+
+            try:
+                # デコード処理 (nvJPEG > TurboJPEG > OpenCV の順にフォールバック)
+                frame = None
+
+                if nv_jpeg is not None:
+                    try:
+                        frame = nv_jpeg.decode(jpeg_data)
+                    except Exception as e:
+                        # GPU側が機能しない環境では以後CPUデコードに切り替える
+                        print(f"[Decode] nvJPEG failed, falling back: {e}")
+                        nv_jpeg = None
+
+                if frame is None and turbo_jpeg is not None:
+                    try:
+                        # ヘッダから元サイズを読み、縮小デコードでIDCT量を削減
+                        src_w, src_h, _, _ = turbo_jpeg.decode_header(jpeg_data)
+                        frame = turbo_jpeg.decode(
+                            jpeg_data, pixel_format=TJPF_BGR,
+                            scaling_factor=pick_scaling_factor(src_w, src_h))
+                    except Exception:
+                        # 壊れたJPEGの可能性もあるため、このフレームのみ
+                        # OpenCVに回す (ハンドルは無効化しない)
+                        frame = None
+
+                if frame is None:
+                    # frombufferはbytes上のゼロコピービュー
+                    # (imdecodeが内部でコピーするため使い回しで問題ない)
+                    frame = cv2.imdecode(
+                        np.frombuffer(jpeg_data, dtype=np.uint8),
+                        cv2.IMREAD_COLOR)
+
+                if frame is None:
+                    print("[Decode] Failed to decode image")
+                    continue
 
-        except Empty:
-            continue
-        except Exception as e:
-            print(f"[Decode] Error: {e}")
+                h, w = frame.shape[:2]
+                if h > MAX_FRAME_H or w > MAX_FRAME_W:
+                    print(f"[Decode] Frame too large: {w}x{h}")
+                    continue
+
+                # 共有メモリの裏面へ書き込み、サイズとスロットを
+                # ロック下でまとめて公開してから表示側へ通知
+                shm_frame[write_slot, :h, :w] = frame
+                with frame_shape.get_lock():
+                    frame_shape[0] = h
+                    frame_shape[1] = w
+                    frame_shape[2] = write_slot
+                frame_ready.set()
+                write_slot = 1 - write_slot
+
+            except Exception as e:
+                print(f"[Decode] Error: {e}")
+
+    finally:
+        shm.close()
+
+
+def parse_args():
+    """コマンドライン引数を解析する
+
+    受信ポートや表示レート違いのコピーを増やさず、
+    1本のスクリプトを引数で使い分けるための入り口。
+    """
+    parser = argparse.ArgumentParser(description="UDP映像受信デバッグビューア")
+    parser.add_argument("--bind", default=BIND_IP,
+                        help=f"バインドするIPアドレス (デフォルト: {BIND_IP})")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help=f"受信するポート番号 (デフォルト: {PORT})")
+    parser.add_argument("--fps", type=int, default=DISPLAY_FPS,
+                        help=f"表示更新レート (デフォルト: {DISPLAY_FPS})")
+    parser.add_argument("--window", default=WINDOW_NAME,
+                        help="表示ウィンドウ名 (複数起動時に変える)")
+    return parser.parse_args()
 
 
 def main():
     global running
+    global BIND_IP, PORT, DISPLAY_FPS, DISPLAY_INTERVAL, WINDOW_NAME
+
+    args = parse_args()
+    BIND_IP = args.bind
+    PORT = args.port
+    DISPLAY_FPS = args.fps
+    DISPLAY_INTERVAL = 1.0 / DISPLAY_FPS
+    WINDOW_NAME = args.window
 
     print("Starting Receiver (Single Stream)...")
 
-    threads = []
+    set_affinity(DISPLAY_CORE)
+
+    # デコード結果受け渡し用の共有メモリを確保
+    # (ポート番号を含めて、複数インスタンス起動時の衝突を防ぐ)
+    shm_name = f"{FRAME_SHM_NAME}_{PORT}"
+    try:
+        shm = shared_memory.SharedMemory(
+            name=shm_name, create=True,
+            size=SHM_SLOTS * MAX_FRAME_H * MAX_FRAME_W * 3)
+    except FileExistsError:
+        # 前回の異常終了で残ったものを引き継ぐ
+        shm = shared_memory.SharedMemory(name=shm_name)
+    shm_frame = np.ndarray(
+        (SHM_SLOTS, MAX_FRAME_H, MAX_FRAME_W, 3),
+        dtype=np.uint8, buffer=shm.buf)
+
+    # (高さ, 幅, 表示すべきスロット番号) をロック付きでまとめて公開する
+    frame_shape = multiprocessing.Array('i', [0, 0, 0])
+    frame_ready = multiprocessing.Event()
 
     # 1. UDP受信スレッド起動
     t_udp = threading.Thread(target=udp_listener, daemon=True)
-    threads.append(t_udp)
     t_udp.start()
 
-    # 2. デコードスレッド起動
-    t_dec = threading.Thread(target=decode_worker, daemon=True)
-    threads.append(t_dec)
-    t_dec.start()
+    # 2. デコードプロセス起動 (受信スレッドとGILを奪い合わないよう別プロセス)
+    p_dec = multiprocessing.Process(
+        target=decode_worker,
+        args=(shm_name, frame_shape, frame_ready),
+        daemon=True)
+    p_dec.start()
+
+    # OpenCLが使える環境ではUMat経由で表示し、ブリットや後段の
+    # リサイズ・色変換をGPU側へ寄せる
+    try:
+        use_opencl = cv2.ocl.haveOpenCL()
+    except AttributeError:
+        use_opencl = False
 
     last_display = 0.0
 
     try:
         while True:
-            now = time.time()
-            # 表示更新レートの制御
-            if now - last_display >= DISPLAY_INTERVAL:
-                if not frame_queue.empty():
-                    frame = frame_queue.get_nowait()
-                    cv2.imshow(WINDOW_NAME, frame)
-                
-                last_display = now
+            shown = False
+
+            # 新フレーム到着までブロック（フレームが無い間のCPU消費をほぼ0に）
+            if frame_ready.wait(timeout=DISPLAY_INTERVAL):
+                frame_ready.clear()
+                now = time.time()
+                # 表示更新レートの制御
+                if now - last_display >= DISPLAY_INTERVAL:
+                    with frame_shape.get_lock():
+                        h = frame_shape[0]
+                        w = frame_shape[1]
+                        slot = frame_shape[2]
+                    if h > 0 and w > 0:
+                        # 公開済みスロットのビューをそのまま表示 (コピーなし)
+                        # デコーダは次フレームを裏面に書くため上書きされない
+                        frame = shm_frame[slot, :h, :w]
+                        if use_opencl:
+                            frame = cv2.UMat(frame)
+                        cv2.imshow(WINDOW_NAME, frame)
+                        shown = True
+
+                    last_display = now
+
+            # キー取得: 表示直後はwaitKey(1)でGUIイベントも処理させる。
+            # それ以外はpollKey()で即時復帰し、~1msの内部スリープを避ける
+            if shown or not _has_pollkey:
+                key = cv2.waitKey(1)
+            else:
+                key = cv2.pollKey()
 
             # 'q'キーで終了
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+            if key != -1 and key & 0xFF == ord('q'):
                 break
 
     except KeyboardInterrupt:
@@ -140,8 +463,15 @@ def main():
     # 終了処理
     running = False
     print("Stopping threads...")
-    time.sleep(0.5) # スレッドの終了を少し待つ
+    os.write(wakeup_w, b"\0")  # リスナーのselectを即時に起こす
+    # リスナー停止後にデコードプロセスへ終了通知を入れる
+    # (先に入れるとリスナーの「古いのを捨てる」処理がNoneを取り出してしまう)
+    t_udp.join(timeout=1.0)
+    jpeg_queue.put(None)
+    p_dec.join(timeout=1.0)
     cv2.destroyAllWindows()
+    shm.close()
+    shm.unlink()
     print("Receiver stopped.")
 
 
@@ -35,6 +35,9 @@ public:
      * @param[in] size 送信データのサイズ (バイト)
      * @return true 送信成功
      * @return false 送信失敗
+     * @details 各パケット先頭に5バイトヘッダ
+     *          (frame_id:u16, seq:u16, flag:u8 いずれもビッグエンディアン)
+     *          を付与する。受信側はこれを用いて欠落・順序入替を検出する
      */
     bool send(const void* data, size_t size);
 
@@ -42,6 +45,7 @@ private:
     int sock_fd_;               /**< ソケットファイルディスクリプタ */
     struct sockaddr_in addr_;   /**< 送信先アドレス情報 */
     bool is_valid_;             /**< 初期化成功フラグ */
+    uint16_t frame_id_ = 0;     /**< フレーム識別子 (send毎にインクリメント) */
 };
 
 #endif
\ No newline at end of file
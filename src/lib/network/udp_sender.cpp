@@ -75,15 +75,31 @@ bool UDPSender::send(const void* data, size_t size)
 
     int packet_count = 0;
 
+    // 途中でエラー終了したフレームと次のフレームがIDを共有しないよう、
+    // 送信開始時点でIDを消費する (u16なので65536フレームで一周する)
+    const uint16_t frame_id = frame_id_;
+    frame_id_ += 1;
+
+    uint16_t seq = 0;
+
     while (offset < size) {
         size_t chunk_size = std::min(MAX_CHUNK_SIZE, size - offset);
 
         uint8_t flag = (offset + chunk_size == size) ? 1 : 0;
 
+        // 5バイトヘッダ (frame_id:u16, seq:u16, flag:u8 ビッグエンディアン)
+        // 受信側で欠落・順序入替を検出し、壊れたフレームを破棄できるようにする
+        uint8_t header[5];
+        header[0] = static_cast<uint8_t>(frame_id >> 8);
+        header[1] = static_cast<uint8_t>(frame_id & 0xFF);
+        header[2] = static_cast<uint8_t>(seq >> 8);
+        header[3] = static_cast<uint8_t>(seq & 0xFF);
+        header[4] = flag;
+
         struct iovec iov[2];
 
-        iov[0].iov_base = &flag;
-        iov[0].iov_len = 1;
+        iov[0].iov_base = header;
+        iov[0].iov_len = sizeof(header);
 
         iov[1].iov_base = const_cast<uint8_t*>(ptr + offset);
         iov[1].iov_len = chunk_size;
@@ -126,6 +142,8 @@ bool UDPSender::send(const void* data, size_t size)
 
         offset += chunk_size;
 
+        seq += 1;
+
         packet_count += 1;
 
         if (packet_count % 10 == 0) {